@@ -15,7 +15,11 @@ Copyright 2025 Martin Alge <martin@alge.se>
    limitations under the License.
 """
 
+import itertools
 import logging
+import queue
+import re
+import threading
 import time
 from pymongo.cursor import CursorType
 from pymongo.errors import (
@@ -34,6 +38,8 @@ from pymongo.errors import (
 MAX_RECONNECT_TIME = 60
 MAX_SLEEP = 5
 RECONNECT_INITIAL_DELAY = 1
+# Matches the server's default first-batch size.
+DEFAULT_BATCH_SIZE = 101
 RETRYABLE_OPERATION_FAILURE_CLASSES = (
     AutoReconnect,
     CursorNotFound,
@@ -43,14 +49,104 @@ RETRYABLE_OPERATION_FAILURE_CLASSES = (
     ServerSelectionTimeoutError,
 )
 ALL_RETRYABLE_EXCEPTIONS = RETRYABLE_OPERATION_FAILURE_CLASSES + (OperationFailure,)
+# except clauses need the tuple above; identity checks use this frozenset
+# for O(1) membership instead of a linear scan.
+_RETRYABLE_OP_FAILURE_SET = frozenset(RETRYABLE_OPERATION_FAILURE_CLASSES)
 log = logging.getLogger(__name__)
 
 
+# Server error codes that indicate a transient condition (shutdown,
+# stepdown, replica-set state change) worth retrying:
+#   91  ShutdownInProgress          189  PrimarySteppedDown
+#   11600 InterruptedAtShutdown     11602 InterruptedDueToReplStateChange
+#   10107 NotWritablePrimary        13435 NotPrimaryNoSecondaryOk
+#   13436 NotPrimaryOrSecondary
+_RETRYABLE_CODES = frozenset({91, 189, 10107, 11600, 11602, 13435, 13436})
+
+# Fallback for errors that carry no code: one precompiled alternation over
+# the known transient message spellings instead of chained substring
+# scans. Matches old and new server vocabulary.
+_RETRYABLE_MSG_RE = re.compile(
+    r'interrupted at shutdown'
+    r'|not master'
+    r'|not primary'
+    r'|node is recovering')
+
+
+def _retry_always(exc):
+    return True
+
+
+def _retry_on_shutdown_message(exc):
+    # The integer code is an O(1) check and recognizes more transient
+    # conditions than the message ever did; the substring search only
+    # remains as a fallback for errors that carry no code.
+    code = getattr(exc, 'code', None)
+    if code is not None:
+        return code in _RETRYABLE_CODES
+    return _RETRYABLE_MSG_RE.search(str(exc.args[0])) is not None
+
+
+# Maps exception class -> predicate deciding whether the exception is
+# retryable, giving O(1) dispatch instead of an isinstance chain plus a
+# message inspection on every raised exception.
+_RETRY_HANDLERS = {cls: _retry_always
+                   for cls in RETRYABLE_OPERATION_FAILURE_CLASSES}
+_RETRY_HANDLERS[OperationFailure] = _retry_on_shutdown_message
+
+
 class MongoReconnectFailure(Exception):
     pass
 
 
+class _BatchIterator(object):
+    """
+    Iterator behind DurableCursor.batch_iter. A hand-written __next__
+    popping from a prefetched batch buffer avoids the frame save/restore
+    a generator pays per yielded document; buffer refills go through the
+    cursor's retry machinery once per batch.
+    """
+
+    __slots__ = ('_cursor', '_batch_size', '_batch', '_idx', '_done')
+
+    def __init__(self, cursor, batch_size):
+        self._cursor = cursor
+        self._batch_size = batch_size
+        self._batch = ()
+        self._idx = 0
+        self._done = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        idx = self._idx
+        if idx < len(self._batch):
+            self._idx = idx + 1
+            return self._batch[idx]
+        if self._done:
+            raise StopIteration
+        batch = self._cursor._fetch_batch(self._batch_size)
+        if not batch:
+            self._done = True
+            raise StopIteration
+        self._batch = batch
+        self._idx = 1
+        return batch[0]
+
+
 class DurableCursor(object):
+    # Long scans can put many of these (plus their wrapped cursors) in
+    # flight; slots keep each instance to a fixed array instead of a full
+    # __dict__.
+    __slots__ = ('collection', 'filter', 'projection', 'sort', 'hint',
+                 'tailable', 'max_reconnect_time',
+                 'initial_reconnect_interval', 'counter', 'skip', 'limit',
+                 'batch_size', 'prefetch', 'disconnect_on_timeout', 'kwargs',
+                 '_find_kwargs', '_exhausted', 'cursor', '_cursor_next',
+                 '_count_cache', '_buf', '_buf_idx', 'resume_by_id',
+                 '_last_id')
+
     logger = log
 
     def __init__(
@@ -65,9 +161,34 @@ class DurableCursor(object):
             initial_reconnect_interval=1,
             skip=0,
             limit=0,
+            batch_size=None,
+            prefetch=False,
+            eager=False,
+            resume_by_id=False,
             disconnect_on_timeout=True,
             **kwargs):
 
+        # Callers often hand us a MongoProxy-wrapped collection (see
+        # manual_tests.py). DurableCursor does its own retrying, so going
+        # through the proxy's Executable wrapper on every find() would be
+        # redundant work; unwrap to the raw pymongo collection up front.
+        # Imported here to keep the module importable on its own.
+        from .mongodb_proxy import MongoProxy
+        if isinstance(collection, MongoProxy):
+            collection = collection.conn
+
+        # With resume_by_id, reconnection filters on the last yielded _id
+        # instead of re-skipping from the start - O(log n) on the _id index
+        # versus the server's O(n) skip scan. That requires iterating in
+        # _id order, so a caller-supplied sort can't be honored.
+        if resume_by_id and sort is not None:
+            raise ValueError('resume_by_id iterates in _id order and '
+                             'cannot be combined with a sort')
+        self.resume_by_id = resume_by_id
+        self._last_id = None
+        if resume_by_id:
+            sort = [('_id', 1)]
+
         self.collection = collection
         self.filter = filter or {}
         self.projection = projection
@@ -78,93 +199,262 @@ class DurableCursor(object):
         self.initial_reconnect_interval = initial_reconnect_interval
         self.counter = self.skip = skip
         self.limit = limit
+        # None leaves batch sizing to the server, which is usually right;
+        # batch_iter also uses this as its slice size so retry windows line
+        # up with server batches.
+        self.batch_size = batch_size
+        self.prefetch = prefetch
         self.disconnect_on_timeout = disconnect_on_timeout
         self.kwargs = kwargs
 
-        self.cursor = self.fetch_cursor(self.counter, self.kwargs)
+        # Preassembled keyword arguments for collection.find; fetch_cursor
+        # only touches the skip/limit entries per call instead of rebuilding
+        # the whole dict on every (re)connect. For PyMongo 3.x, 'tailable'
+        # is controlled via cursor_type.
+        self._find_kwargs = dict(
+            filter=self.filter,
+            projection=self.projection,
+            sort=self.sort,
+            cursor_type=(CursorType.TAILABLE_AWAIT if tailable
+                         else CursorType.NON_TAILABLE),
+            **kwargs)
+        if batch_size is not None:
+            self._find_kwargs['batch_size'] = batch_size
+
+        # Cached count() results, keyed by the with_limit_and_skip flag.
+        self._count_cache = {}
+
+        # Set by fetch_cursor when the user's limit is exactly consumed, so
+        # reconnection doesn't waste a round-trip on an empty batch.
+        self._exhausted = False
+
+        self.cursor = self.fetch_cursor(self.counter)
+        # Bound __next__ of the current cursor, rebound on every reload, so
+        # the per-document hot path doesn't build a fresh closure per call.
+        self._cursor_next = self.cursor.__next__
+
+        # Eager mode drains the whole result set up front (through the
+        # normal retry machinery), trading memory for C-speed list
+        # iteration afterwards. Best for small result sets.
+        self._buf = None
+        # Read position for direct next() calls against the eager buffer.
+        self._buf_idx = 0
+        if eager:
+            self._buf = list(self.batch_iter())
 
     def __iter__(self):
+        if self._buf is not None:
+            return iter(self._buf)
+        if self.prefetch:
+            return self._prefetch_iter()
         return self
 
-    def fetch_cursor(self, count, cursor_kwargs):
+    def fetch_cursor(self, count):
         """
         Gets a cursor for the options set in the object, using the
         correct API for PyMongo 3.x.
         """
-        log.debug("DurableCursor: Entering fetch_cursor with count=%d, limit=%d, initial_skip=%d",
-                  count, self.limit, self.skip)
+        debug = log.isEnabledFor(logging.DEBUG)
+        if debug:
+            log.debug("DurableCursor: Entering fetch_cursor with count=%d, limit=%d, initial_skip=%d",
+                      count, self.limit, self.skip)
 
-        limit_is_zero = False
         if self.limit:
             limit = self.limit - (count - self.skip)
-            log.debug("DurableCursor: fetch_cursor calculated new limit=%d", limit)
+            if debug:
+                log.debug("DurableCursor: fetch_cursor calculated new limit=%d", limit)
             if limit <= 0:
-                limit = 1
-                limit_is_zero = True
+                # The limit is exactly consumed; hand back an empty iterator
+                # instead of fetching a sentinel batch just to drain it.
+                self._exhausted = True
+                return iter(())
         else:
             limit = 0
 
-        # For PyMongo 3.x, 'tailable' is controlled via cursor_type
-        cursor_type = CursorType.TAILABLE_AWAIT if self.tailable else CursorType.NON_TAILABLE
-
-        cursor = self.collection.find(
-            filter=self.filter,
-            projection=self.projection,
-            sort=self.sort,
-            skip=count,
-            limit=limit,
-            cursor_type=cursor_type,
-            **cursor_kwargs
-        )
+        kw = self._find_kwargs
+        if self.resume_by_id and self._last_id is not None:
+            kw = dict(kw)
+            kw['filter'] = dict(self.filter, _id={'$gt': self._last_id})
+            kw['skip'] = 0
+        else:
+            kw['skip'] = count
+        kw['limit'] = limit
+        # Safe to reuse the dict: find() copies its keyword arguments.
+        cursor = self.collection.find(**kw)
 
         # 'hint' is a separate method call on the cursor in PyMongo 3.x
         if self.hint:
             cursor.hint(self.hint)
 
-        if limit_is_zero:
-            next(cursor, None)
-
-        log.debug("DurableCursor: fetch_cursor returning new cursor.")
+        if debug:
+            log.debug("DurableCursor: fetch_cursor returning new cursor.")
         return cursor
 
     def reload_cursor(self):
-        log.debug("DurableCursor: reload_cursor called. Current counter is %d.", self.counter)
-        self.cursor = self.fetch_cursor(self.counter, self.kwargs)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("DurableCursor: reload_cursor called. Current counter is %d.", self.counter)
+        self.cursor = self.fetch_cursor(self.counter)
+        self._cursor_next = self.cursor.__next__
 
     @property
     def alive(self):
-        return self.tailable and self.cursor.alive
+        # Once the limit is exactly consumed, fetch_cursor hands back a
+        # plain empty iterator with no .alive; the cursor is dead anyway.
+        return self.tailable and not self._exhausted and self.cursor.alive
 
     def __next__(self):
-        log.debug("DurableCursor: __next__ called. About to call _with_retry.")
-        next_record = self._with_retry(get_next=True, f=lambda: next(self.cursor))
+        if self._buf is not None:
+            # Eager mode drained the underlying cursor into the buffer, so
+            # direct next() calls must be served from there too.
+            idx = self._buf_idx
+            if idx >= len(self._buf):
+                raise StopIteration
+            self._buf_idx = idx + 1
+            return self._buf[idx]
+        if self._exhausted:
+            raise StopIteration
+        # Guarded: even a disabled log.debug costs a call plus argument
+        # evaluation per iterated document.
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("DurableCursor: __next__ called. About to call _with_retry.")
+        next_record = self._with_retry(self._cursor_next)
         self.counter += 1
-        log.debug("DurableCursor: __next__ success. Counter is now %d.", self.counter)
+        if self.resume_by_id:
+            self._last_id = next_record.get('_id')
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("DurableCursor: __next__ success. Counter is now %d.", self.counter)
         return next_record
 
     next = __next__
 
-    def _with_retry(self, get_next, f, *args, **kwargs):
+    def batch_iter(self, batch_size=None):
+        """
+        Iterate documents a batch at a time, only re-entering the retry
+        machinery on batch boundaries instead of once per document.
+        Consumers scanning very large result sets should prefer this over
+        plain iteration. A batch that fails halfway is discarded and
+        re-fetched from the current counter, so no documents are skipped.
+        Defaults to the cursor's batch_size so the slice size lines up
+        with the server's batches.
+        """
+        batch_size = batch_size or self.batch_size or DEFAULT_BATCH_SIZE
+        return _BatchIterator(self, batch_size)
+
+    def _fetch_batch(self, batch_size):
+        """
+        Fetch the next batch of up to batch_size documents through the
+        retry machinery, advancing the counter. A batch that fails halfway
+        is discarded and re-fetched from the current counter, so no
+        documents are skipped or duplicated. Empty list means exhausted.
+        """
+        while True:
+            batch = self._with_retry(
+                lambda: list(itertools.islice(self.cursor, batch_size)),
+                get_next=False)
+            if batch is True:
+                # try_reconnect reloaded the cursor; fetch the batch again.
+                continue
+            if batch:
+                self.counter += len(batch)
+                if self.resume_by_id:
+                    self._last_id = batch[-1].get('_id')
+            return batch
+
+    def to_list(self, length=None):
+        """
+        Materialize up to `length` remaining documents (all of them when
+        None) as a list. Drains through batch_iter, so the retry machinery
+        is entered once per batch rather than once per document - the
+        cheapest way to consume a whole result set at once.
+        """
+        if self._buf is not None:
+            return list(self._buf) if length is None else self._buf[:length]
+        if length is not None:
+            return list(itertools.islice(self.batch_iter(), length))
+        return list(self.batch_iter())
+
+    def _prefetch_iter(self):
+        """
+        Yield documents from batches fetched by a background worker thread,
+        so the next getMore round-trip overlaps with processing of the
+        current batch. The worker owns all cursor and counter state and
+        runs the usual retry machinery; an error that survives it is
+        forwarded through the queue and re-raised here.
+        """
+        batches = queue.Queue(maxsize=1)
+        done = object()
+        stop = threading.Event()
+        batch_size = self.batch_size or DEFAULT_BATCH_SIZE
+
+        def put(item):
+            # Interruptible put: a consumer that abandons iteration early
+            # sets `stop`, and the worker must not stay blocked forever on
+            # the full queue.
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def worker():
+            try:
+                while not stop.is_set():
+                    batch = self._fetch_batch(batch_size)
+                    if not batch:
+                        break
+                    if not put(batch):
+                        return
+            except BaseException as exc:
+                put(exc)
+                return
+            put(done)
+
+        threading.Thread(target=worker, name='durable-cursor-prefetch',
+                         daemon=True).start()
+        try:
+            while True:
+                item = batches.get()
+                if item is done:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                for doc in item:
+                    yield doc
+        finally:
+            # Runs on exhaustion and when the consumer closes the generator
+            # early (break / garbage collection); lets the worker exit.
+            stop.set()
+
+    def _with_retry(self, f, get_next=True):
         try:
-            return f(*args, **kwargs)
+            return f()
         except ALL_RETRYABLE_EXCEPTIONS as exc:
             log.warning("DurableCursor: _with_retry caught exception: %r", exc)
 
-            if isinstance(exc, OperationFailure):
-                is_retryable_op_failure = (
-                    'interrupted at shutdown' in str(exc.args[0]) or
-                    exc.__class__ in RETRYABLE_OPERATION_FAILURE_CLASSES
-                )
-                if not is_retryable_op_failure:
-                    log.error("DurableCursor: Unhandleable OperationFailure. Re-raising.")
-                    raise
+            handler = _RETRY_HANDLERS.get(type(exc))
+            if handler is None:
+                # A subclass we haven't seen yet; classify it once with the
+                # isinstance walk and memoize the verdict for next time.
+                if (type(exc) in _RETRYABLE_OP_FAILURE_SET or
+                        not isinstance(exc, OperationFailure) or
+                        isinstance(exc, RETRYABLE_OPERATION_FAILURE_CLASSES)):
+                    handler = _retry_always
+                else:
+                    handler = _retry_on_shutdown_message
+                _RETRY_HANDLERS[type(exc)] = handler
+            if not handler(exc):
+                log.error("DurableCursor: Unhandleable OperationFailure. Re-raising.")
+                raise
 
-            log.debug("DurableCursor: Exception is retryable. Calling try_reconnect.")
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("DurableCursor: Exception is retryable. Calling try_reconnect.")
             return self.try_reconnect(get_next=get_next)
 
     def try_reconnect(self, get_next=True):
         log.debug("DurableCursor: Entered try_reconnect.")
-        start = time.time()
+        start = time.monotonic()
         interval = self.initial_reconnect_interval
 
         while True:
@@ -174,7 +464,7 @@ class DurableCursor(object):
                 return next(self.cursor) if get_next else True
             except RETRYABLE_OPERATION_FAILURE_CLASSES as e:
                 log.warning("DurableCursor: try_reconnect caught %r during inner loop.", e)
-                if time.time() - start > self.max_reconnect_time:
+                if time.monotonic() - start > self.max_reconnect_time:
                     log.error('DurableCursor: Reconnect timed out.')
                     raise MongoReconnectFailure()
 
@@ -182,11 +472,45 @@ class DurableCursor(object):
                 time.sleep(interval)
                 interval = min(interval * 2, MAX_SLEEP)
 
+    def __length_hint__(self):
+        """
+        Size estimate letting list(cursor) preallocate its capacity in one
+        go instead of growing incrementally. Only uses information already
+        in hand - the eager buffer or a cached count() - and never costs a
+        server round-trip; 0 means no estimate.
+        """
+        if self._buf is not None:
+            return len(self._buf)
+        # The with_limit_and_skip count matches what iteration will yield;
+        # the plain count is at least an upper bound.
+        cached = self._count_cache.get(True)
+        if cached is None:
+            cached = self._count_cache.get(False)
+        return cached if cached is not None else 0
+
     def count(self, with_limit_and_skip=False):
-        cursor = self.collection.find(self.filter)
+        """
+        Number of documents matching the filter. The server-side count is
+        a collection scan, so the result is cached per flag value; call
+        invalidate_count() if the collection may have changed.
+        """
+        cached = self._count_cache.get(with_limit_and_skip)
+        if cached is not None:
+            return cached
+        # An eagerly materialized buffer already is the (limit/skip
+        # adjusted) result set; no server round-trip needed.
+        if self._buf is not None and (with_limit_and_skip or
+                                      not (self.skip or self.limit)):
+            return len(self._buf)
+        count_kwargs = {}
         if with_limit_and_skip:
             if self.skip:
-                cursor = cursor.skip(self.skip)
+                count_kwargs['skip'] = self.skip
             if self.limit:
-                cursor = cursor.limit(self.limit)
-        return cursor.count(with_limit_and_skip=with_limit_and_skip)
\ No newline at end of file
+                count_kwargs['limit'] = self.limit
+        result = self.collection.count_documents(self.filter, **count_kwargs)
+        self._count_cache[with_limit_and_skip] = result
+        return result
+
+    def invalidate_count(self):
+        self._count_cache.clear()
\ No newline at end of file
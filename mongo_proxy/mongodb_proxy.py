@@ -15,13 +15,17 @@ Copyright 2025 Martin Alge <martin@alge.se>
    limitations under the License.
 """
 
+import random
 import time
+import weakref
 import pymongo
 from pymongo import MongoClient
 
+from .durable_cursor import _RETRYABLE_CODES
+
 # A curated set of method names that perform network I/O and need to be
 # wrapped in the Executable class for retry-logic.
-EXECUTABLE_MONGO_METHODS = {
+EXECUTABLE_MONGO_METHODS = frozenset({
     'aggregate', 'bulk_write', 'count', 'count_documents', 'create_index',
     'delete_many', 'delete_one', 'distinct', 'drop', 'drop_index',
     'find', 'find_one', 'find_one_and_delete', 'find_one_and_replace',
@@ -30,7 +34,7 @@ EXECUTABLE_MONGO_METHODS = {
     'command', 'create_collection', 'drop_collection', 'list_collection_names',
     'validate_collection',
     'drop_database', 'list_database_names',
-}
+})
 
 # Add mongomock types to our check if it's installed for testing
 try:
@@ -42,6 +46,23 @@ except ImportError:
 PYMONGO_TYPES = (pymongo.MongoClient, pymongo.database.Database, pymongo.collection.Collection)
 CHAINABLE_TYPES = PYMONGO_TYPES + MONGOMOCK_TYPES
 
+# Non-executable callables that can hand back a new client/database/
+# collection and therefore need their result re-wrapped in a proxy.
+# Everything else returns primitives, cursors or result objects that
+# should pass through untouched.
+_CHAINABLE_RETURNING_METHODS = frozenset({
+    'with_options', 'get_database', 'get_default_database', 'get_collection',
+})
+
+
+def _prewarm_client(client, logger):
+    try:
+        client.admin.command('ping')
+    except Exception as e:
+        # Purely best-effort; the normal retry machinery deals with a
+        # server that is actually unreachable.
+        logger.warning('Prewarm ping failed: %s', e)
+
 
 def get_client(obj):
     if isinstance(obj, pymongo.collection.Collection):
@@ -50,74 +71,454 @@ def get_client(obj):
         return obj.client
     elif isinstance(obj, MongoClient):
         return obj
+    elif isinstance(obj, CHAINABLE_TYPES):
+        # mongomock mirrors pymongo's object graph, so walk it the same
+        # way: collection -> database -> client.
+        database = getattr(obj, 'database', None)
+        if database is not None:
+            return database.client
+        return getattr(obj, 'client', obj)
     else:
         return None
 
 
+# Errors that indicate a (possibly transient) loss of connectivity and are
+# worth retrying. NetworkTimeout, ServerSelectionTimeoutError and
+# NotPrimaryError all subclass AutoReconnect, so a single entry matches
+# them all with one type check on the exception path.
+RECONNECT_ERRORS = (pymongo.errors.AutoReconnect,)
+
+# Longest time to sleep between two retries, in seconds.
+MAX_SLEEP = 5
+
+# Bulk methods whose ordered form can be resumed mid-batch after a
+# transient failure without replaying already-acknowledged writes.
+_BULK_METHODS = frozenset({'insert_many', 'bulk_write'})
+
+# Consecutive reconnect failures before the per-client circuit breaker
+# opens, and how long it then fails fast before letting a probe through.
+BREAKER_FAILURE_THRESHOLD = 10
+BREAKER_COOLDOWN = 1.0
+
+# Exponential backoff schedule, precomputed so the retry loop just indexes
+# a tuple instead of recomputing pow(2, i) * 0.5 on every attempt.
+_BACKOFF = tuple(min(MAX_SLEEP, 0.5 * 2 ** k) for k in range(20))
+
+
+# How long identical warnings are suppressed during a retry storm.
+_LOG_SUPPRESS_WINDOW = 5.0
+
+
+class _RateLimitedLogger(object):
+    """
+    Thin wrapper around a logger that suppresses duplicate warnings for a
+    short window, keyed by the format string, so a failover storm doesn't
+    emit thousands of identical lines at the very moment the process is
+    already under stress. When a suppressed message fires again after the
+    window, the number of swallowed repeats is summarized first. All other
+    logger methods pass straight through.
+    """
+
+    __slots__ = ('_logger', '_window', '_seen')
+
+    def __init__(self, logger, window=_LOG_SUPPRESS_WINDOW):
+        self._logger = logger
+        self._window = window
+        self._seen = {}  # format string -> [last_emitted, suppressed_count]
+
+    def __getattr__(self, name):
+        return getattr(self._logger, name)
+
+    def warning(self, msg, *args, **kwargs):
+        now = time.monotonic()
+        entry = self._seen.get(msg)
+        if entry is not None:
+            if now - entry[0] < self._window:
+                entry[1] += 1
+                return
+            if entry[1]:
+                self._logger.warning(
+                    '(%d similar warnings suppressed in the last %.0f seconds)',
+                    entry[1], now - entry[0])
+        self._seen[msg] = [now, 0]
+        self._logger.warning(msg, *args, **kwargs)
+
+
+class _Breaker(object):
+    """
+    Circuit breaker shared by all Executables bound to the same client.
+    After `threshold` consecutive reconnect failures the breaker opens for
+    `cooldown` seconds and calls fail fast with the last seen error
+    instead of each paying the full server-selection timeout. Once the
+    cooldown expires the next call goes through as a probe (half-open); a
+    success closes the breaker, a failure re-opens it. Counter updates are
+    plain attribute writes, which is atomic enough under the GIL for this
+    heuristic.
+    """
+
+    __slots__ = ('threshold', 'cooldown', 'failures', 'open_until',
+                 'last_exc', '__weakref__')
+
+    def __init__(self, threshold=BREAKER_FAILURE_THRESHOLD,
+                 cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0.0
+        self.last_exc = None
+
+    def is_open(self):
+        return time.monotonic() < self.open_until
+
+    def record_failure(self, exc):
+        self.failures += 1
+        self.last_exc = exc
+        if self.failures >= self.threshold:
+            # Also re-opens after a failed half-open probe.
+            self.open_until = time.monotonic() + self.cooldown
+
+    def record_success(self):
+        self.failures = 0
+        self.open_until = 0.0
+        self.last_exc = None
+
+
+# One breaker per client, shared by every Executable bound to it. Weak
+# values so a breaker dies with its last Executable.
+_breaker_registry = weakref.WeakValueDictionary()
+
+
+def _get_breaker(client):
+    key = id(client)
+    breaker = _breaker_registry.get(key)
+    if breaker is None:
+        breaker = _Breaker()
+        _breaker_registry[key] = breaker
+    return breaker
+
+
 class Executable(object):
     """ Wrap a MongoDB-method and handle AutoReconnect-exceptions. """
 
+    __slots__ = ('method', 'logger', 'wait_time', 'disconnect_on_timeout',
+                 'max_retries', '_client', '_breaker', '_is_bulk',
+                 '_backoff', 'deadline', '__weakref__')
+
     def __init__(self, method, logger, wait_time=None,
-                 disconnect_on_timeout=True):
+                 disconnect_on_timeout=True, max_retries=None,
+                 wait_min=None, wait_max=None, deadline=None):
         self.method = method
+        if not isinstance(logger, _RateLimitedLogger):
+            logger = _RateLimitedLogger(logger)
         self.logger = logger
         self.wait_time = wait_time or 120
         self.disconnect_on_timeout = disconnect_on_timeout
+        if max_retries is None:
+            # Only a safety valve against pathological clocks: the
+            # elapsed-time checks in _retry_slow decide when to give up.
+            # Sized at the jitter floor (sleeps can be as short as 0.5x
+            # the schedule) plus ramp-up headroom, so the attempt budget
+            # cannot expire before the 2*wait_time budget does.
+            max_retries = int(2 * self.wait_time / (0.5 * MAX_SLEEP)) + 16
+        self.max_retries = max_retries
+        if wait_min is None and wait_max is None:
+            self._backoff = _BACKOFF
+        else:
+            # Custom backoff bounds; precompute the schedule once so the
+            # retry loop still just indexes a tuple.
+            wait_min = 0.5 if wait_min is None else wait_min
+            wait_max = MAX_SLEEP if wait_max is None else wait_max
+            self._backoff = tuple(min(wait_max, wait_min * 2 ** k)
+                                  for k in range(len(_BACKOFF)))
+        # The method is fixed for the lifetime of the wrapper, so resolve
+        # its owning client once instead of on every retry.
+        self._client = get_client(getattr(method, '__self__', None))
+        self._breaker = (_get_breaker(self._client)
+                         if self._client is not None else None)
+        self._is_bulk = getattr(method, '__name__', None) in _BULK_METHODS
+        if deadline is not None and not hasattr(pymongo, 'timeout'):
+            # pymongo.timeout arrived in 4.2; degrade gracefully before that.
+            logger.warning('deadline ignored: this pymongo has no timeout()')
+            deadline = None
+        self.deadline = deadline
 
     def __call__(self, *args, **kwargs):
-        start = time.time()
+        breaker = self._breaker
+        if breaker is not None and breaker.is_open():
+            # Raise a fresh exception per caller: re-raising the stored
+            # instance would let concurrent threads rewrite each other's
+            # in-flight __traceback__.
+            raise pymongo.errors.AutoReconnect(
+                'circuit breaker open: %s' % breaker.last_exc
+            ) from breaker.last_exc
+        try:
+            # The result is handled by MongoProxy.__call__, so we just return it
+            if self.deadline is None:
+                result = self.method(*args, **kwargs)
+            else:
+                attempt_start = time.monotonic()
+                with pymongo.timeout(self.deadline):
+                    result = self.method(*args, **kwargs)
+        except RECONNECT_ERRORS as e:
+            # Nearly all calls succeed on the first try; keep the retry
+            # bookkeeping out of the hot path.
+            if (self.deadline is not None and
+                    time.monotonic() - attempt_start >= self.deadline):
+                # The deadline budget really is spent; retrying would only
+                # blow further past it. Timeout-category errors that arrive
+                # with budget left are still transient and retried.
+                raise
+            return self._retry_slow(e, args, kwargs)
+        except pymongo.errors.BulkWriteError as e:
+            return self._retry_bulk(e, args, kwargs)
+        if breaker is not None and breaker.failures:
+            breaker.record_success()
+        return result
+
+    def _retry_slow(self, exc, args, kwargs):
+        start = time.monotonic()
         round_num = 1
         i = 0
         disconnected = False
         max_time = self.wait_time
-        reconnect_errors = (pymongo.errors.AutoReconnect, pymongo.errors.NetworkTimeout, pymongo.errors.ServerSelectionTimeoutError)
-        while True:
+        method = self.method
+        breaker = self._breaker
+        if breaker is not None:
+            breaker.record_failure(exc)
+        for _ in range(self.max_retries):
+            delta = time.monotonic() - start
+            if delta >= max_time:
+                client = self._client
+                if not self.disconnect_on_timeout or disconnected or client is None:
+                    self.logger.error("AutoReconnect timed out after %.1f seconds.", delta)
+                    raise exc
+                client.close()
+                disconnected = True
+                max_time *= 2
+                round_num = 2
+                i = 0
+                self.logger.warning('Resetting clock for round 2 after disconnecting')
+            # Jitter the backoff so many clients hitting the same failover
+            # don't retry in lockstep and re-storm the new primary.
+            backoff = self._backoff
+            sleep_for = backoff[i if i < len(backoff) else -1] * (0.5 + random.random())
+            self.logger.warning('AutoReconnecting due to %s, try %d.%d (%.1f seconds elapsed), sleeping %.2f seconds',
+                                type(exc).__name__, round_num, i, delta, sleep_for)
+            time.sleep(sleep_for)
+            i += 1
             try:
-                # The result is handled by MongoProxy.__call__, so we just return it
-                return self.method(*args, **kwargs)
-            except reconnect_errors as e:
-                end = time.time()
-                delta = end - start
-                if delta >= max_time:
-                    if not self.disconnect_on_timeout or disconnected:
-                        self.logger.error("AutoReconnect timed out after %.1f seconds.", delta)
-                        raise
-                    client = get_client(self.method.__self__)
-                    if client:
-                        client.close()
-                        disconnected = True
-                        max_time *= 2
-                        round_num = 2
-                        i = 0
-                        self.logger.warning('Resetting clock for round 2 after disconnecting')
-                self.logger.warning('AutoReconnecting due to %s, try %d.%d (%.1f seconds elapsed)',
-                                    type(e).__name__, round_num, i, delta)
-                time.sleep(min(5, pow(2, i) * 0.5))
-                i += 1
+                if self.deadline is None:
+                    result = method(*args, **kwargs)
+                else:
+                    attempt_start = time.monotonic()
+                    with pymongo.timeout(self.deadline):
+                        result = method(*args, **kwargs)
+            except RECONNECT_ERRORS as e:
+                if (self.deadline is not None and
+                        time.monotonic() - attempt_start >= self.deadline):
+                    raise
+                exc = e
+                if breaker is not None:
+                    breaker.record_failure(e)
+            else:
+                if breaker is not None:
+                    breaker.record_success()
+                return result
+        self.logger.error("AutoReconnect giving up after %d retries.", self.max_retries)
+        raise exc
+
+    def _retry_bulk(self, exc, args, kwargs):
+        """
+        Resume an ordered bulk operation after a transient failure without
+        replaying writes the server already acknowledged. Only engages when
+        every reported write error carries a transient server code and the
+        batch made progress; anything else (unordered batches, real write
+        errors, no progress) re-raises the original error.
+        """
+        if not self._is_bulk or not args:
+            raise exc
+        # 'ordered' is the second positional parameter of both insert_many
+        # and bulk_write, so it may arrive in args instead of kwargs.
+        ordered = args[1] if len(args) > 1 else kwargs.get('ordered', True)
+        if not ordered:
+            raise exc
+        details = exc.details or {}
+        write_errors = details.get('writeErrors') or []
+        if not write_errors or not all(
+                err.get('code') in _RETRYABLE_CODES for err in write_errors):
+            raise exc
+        first_failed = min(err['index'] for err in write_errors)
+        if first_failed <= 0:
+            # Nothing committed; resuming would just replay the same batch.
+            raise exc
+        try:
+            remaining = args[0][first_failed:]
+        except TypeError:
+            # Non-sliceable request iterables can't be resumed safely.
+            raise exc
+        self.logger.warning(
+            'Resuming %s after transient bulk failure: first %d operations '
+            'committed, reissuing the remaining %d.',
+            getattr(self.method, '__name__', '?'), first_failed, len(remaining))
+        # Going through __call__ gives the tail the full reconnect handling
+        # and allows further resumption; first_failed > 0 guarantees
+        # progress, so this terminates.
+        return self(remaining, *args[1:], **kwargs)
+
+
+# Executables shared across proxy instances, keyed by the identity of the
+# bound method's owner, the underlying function and the wrapper
+# configuration. Values are weak so the cache never keeps an Executable
+# alive on its own; the per-proxy _attr_cache holds the strong reference.
+_executable_cache = weakref.WeakValueDictionary()
+
+
+def _get_executable(method, logger, wait_time, disconnect_on_timeout):
+    owner = getattr(method, '__self__', method)
+    key = (id(owner), getattr(method, '__func__', method), id(logger),
+           wait_time, disconnect_on_timeout)
+    executable = _executable_cache.get(key)
+    if executable is None:
+        executable = Executable(method, logger, wait_time,
+                                disconnect_on_timeout)
+        _executable_cache[key] = executable
+    return executable
+
+
+class _ExecutableAttribute(object):
+    """
+    Descriptor emitted on specialized proxy classes for methods in
+    EXECUTABLE_MONGO_METHODS. Accessing the attribute resolves through a
+    normal MRO lookup instead of the slower __getattr__ fallback.
+    """
+
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        cached = obj._attr_cache.get(self.name)
+        if cached is not None:
+            return cached
+        wrapped = _get_executable(getattr(obj.conn, self.name), obj.logger,
+                                  obj.wait_time, obj.disconnect_on_timeout)
+        obj._attr_cache[self.name] = wrapped
+        return wrapped
+
+
+class _ChainableAttribute(object):
+    """
+    Lazy, cached_property-style descriptor for the remaining public
+    attributes of a specialized proxy class. The first access wraps the
+    attribute in a MongoProxy and memoizes it in the instance's
+    _attr_cache (the slot-compatible stand-in for a __dict__), so
+    subsequent accesses skip the wrapping entirely.
+    """
+
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        cached = obj._attr_cache.get(self.name)
+        if cached is not None:
+            return cached
+        wrapped = MongoProxy(getattr(obj.conn, self.name), obj.logger,
+                             obj.wait_time, obj.disconnect_on_timeout)
+        obj._attr_cache[self.name] = wrapped
+        return wrapped
 
 
 class MongoProxy(object):
     """ Proxy for MongoDB connection. """
+
+    __slots__ = ('conn', 'logger', 'wait_time', 'disconnect_on_timeout',
+                 '_attr_cache', '_item_cache')
+
+    def __new__(cls, conn, *args, **kwargs):
+        # Dispatch to a specialized subclass of MongoProxy for the wrapped
+        # type, so executable methods are found via class-level descriptors
+        # rather than the __getattr__ fallback.
+        if cls is MongoProxy:
+            conn_cls = type(conn)
+            proxy_cls = _proxy_class_cache.get(conn_cls)
+            if proxy_cls is None:
+                proxy_cls = _make_proxy_class(conn_cls)
+                _proxy_class_cache[conn_cls] = proxy_cls
+            return object.__new__(proxy_cls)
+        return object.__new__(cls)
+
     def __init__(self, conn, logger=None, wait_time=None,
-                 disconnect_on_timeout=True):
+                 disconnect_on_timeout=True, prewarm=False):
         if logger is None:
             import logging
             logger = logging.getLogger(__name__)
 
+        if prewarm and isinstance(conn, MongoClient):
+            # Kick off topology discovery in the background so the first
+            # real operation doesn't pay the full server-selection delay.
+            import threading
+            threading.Thread(
+                target=_prewarm_client, args=(conn, logger),
+                name='mongo-proxy-prewarm', daemon=True).start()
+
         object.__setattr__(self, 'conn', conn)
         object.__setattr__(self, 'logger', logger)
         object.__setattr__(self, 'wait_time', wait_time)
         object.__setattr__(self, 'disconnect_on_timeout', disconnect_on_timeout)
+        # Memoizes wrapped attributes so hot chains like
+        # proxy.db.collection.insert_one don't rebuild wrapper objects on
+        # every access.
+        object.__setattr__(self, '_attr_cache', {})
+        # Separate cache for subscripted children: a database may contain a
+        # collection whose name collides with an executable method name, so
+        # item and attribute lookups must not share entries.
+        object.__setattr__(self, '_item_cache', {})
+
+    @classmethod
+    def from_uri(cls, uri, logger=None, wait_time=None,
+                 disconnect_on_timeout=True, **client_options):
+        """
+        Build a MongoProxy around a shared MongoClient for uri. Repeated
+        calls with the same URI and options reuse the same client, so a
+        process keeps a single connection pool per cluster no matter how
+        many proxies it creates. Pool sizing defaults to maxPoolSize=100
+        unless overridden in client_options.
+        """
+        client_options.setdefault('maxPoolSize', 100)
+        key = (uri, tuple(sorted(client_options.items())))
+        client = _client_registry.get(key)
+        if client is None:
+            client = MongoClient(uri, **client_options)
+            _client_registry[key] = client
+        return cls(client, logger, wait_time, disconnect_on_timeout)
 
     def __getitem__(self, key):
+        cached = self._item_cache.get(key)
+        if cached is not None:
+            return cached
         item = self.conn[key]
-        return MongoProxy(item, self.logger, self.wait_time, self.disconnect_on_timeout)
+        wrapped = MongoProxy(item, self.logger, self.wait_time, self.disconnect_on_timeout)
+        self._item_cache[key] = wrapped
+        return wrapped
 
     def __getattr__(self, key):
+        cached = self._attr_cache.get(key)
+        if cached is not None:
+            return cached
         attr = getattr(self.conn, key)
         if key in EXECUTABLE_MONGO_METHODS:
-            return Executable(attr, self.logger, self.wait_time, self.disconnect_on_timeout)
-        return MongoProxy(attr, self.logger, self.wait_time, self.disconnect_on_timeout)
+            wrapped = _get_executable(attr, self.logger, self.wait_time, self.disconnect_on_timeout)
+        else:
+            wrapped = MongoProxy(attr, self.logger, self.wait_time, self.disconnect_on_timeout)
+        self._attr_cache[key] = wrapped
+        return wrapped
 
     def __call__(self, *args, **kwargs):
         """
@@ -127,6 +528,13 @@ class MongoProxy(object):
         # Get the result from the wrapped object (e.g. the with_options method)
         result = self.conn(*args, **kwargs)
 
+        # Methods known not to produce a chainable object skip the
+        # isinstance check entirely; anything unnamed or unknown falls
+        # through to the check as before.
+        name = getattr(self.conn, '__name__', None)
+        if name is not None and name not in _CHAINABLE_RETURNING_METHODS:
+            return result
+
         # If the result is a new chainable object, re-wrap it in a proxy
         if isinstance(result, CHAINABLE_TYPES):
             return MongoProxy(result, self.logger, self.wait_time, self.disconnect_on_timeout)
@@ -138,8 +546,22 @@ class MongoProxy(object):
         if key in ('conn', 'logger', 'wait_time', 'disconnect_on_timeout'):
             object.__setattr__(self, key, value)
         else:
+            # The cached wrapper (if any) is now stale.
+            self._attr_cache.pop(key, None)
             setattr(self.conn, key, value)
 
+    # Dunder lookups bypass __getattr__ on new-style classes, so iteration
+    # support has to be spelled out explicitly. Delegating without wrapping
+    # also keeps cursor iteration off the proxy machinery.
+    def __iter__(self):
+        return iter(self.conn)
+
+    def __next__(self):
+        return next(self.conn)
+
+    def __len__(self):
+        return len(self.conn)
+
     def __dir__(self):
         return dir(self.conn)
 
@@ -153,4 +575,35 @@ class MongoProxy(object):
         return self.conn == other
 
     def __bool__(self):
-        return True
\ No newline at end of file
+        return True
+
+
+# Shared MongoClients keyed by URI and client options, so repeated
+# from_uri calls reuse one client (and its connection pool) per cluster
+# instead of opening a fresh topology each time.
+_client_registry = {}
+
+# Specialized MongoProxy subclasses, keyed by the type of the wrapped object.
+_proxy_class_cache = {}
+
+
+def _make_proxy_class(conn_cls):
+    """
+    Build a MongoProxy subclass specialized for conn_cls, with a descriptor
+    for each executable method the class actually defines. Everything else
+    still goes through MongoProxy.__getattr__ (which also covers attributes
+    that only exist dynamically, like databases on a client).
+    """
+    # Intersect once at class-build time so the dispatch table only holds
+    # methods this particular class actually has.
+    executable_names = EXECUTABLE_MONGO_METHODS.intersection(dir(conn_cls))
+    namespace = {'__slots__': ()}
+    reserved = frozenset(dir(MongoProxy))
+    for name in dir(conn_cls):
+        if name.startswith('_') or name in reserved:
+            continue
+        if name in executable_names:
+            namespace[name] = _ExecutableAttribute(name)
+        else:
+            namespace[name] = _ChainableAttribute(name)
+    return type('MongoProxy_%s' % conn_cls.__name__, (MongoProxy,), namespace)
\ No newline at end of file
@@ -39,10 +39,10 @@ setup(
         'Programming Language :: Python :: 3.9',
     ],
     python_requires='>=3.6',
-    install_requires=['pymongo>=3.12,<4.0'],
+    install_requires=['pymongo>=3.12,<5.0'],
     test_suite='tests',
     extras_require={
-        'test': ['pytest', 'pytest-mock', 'mongomock'],
+        'test': ['pytest', 'pytest-mock', 'pytest-xdist', 'mongomock'],
     },
     url="https://github.com/Alge/MongoDBProxy.git",
 )
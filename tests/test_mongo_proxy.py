@@ -1,5 +1,8 @@
+import threading
+import time
+
 import pytest
-from unittest.mock import call, MagicMock
+from unittest.mock import call
 import pymongo
 import pymongo.errors
 from pymongo.read_preferences import ReadPreference
@@ -7,7 +10,68 @@ from pymongo.write_concern import WriteConcern
 import mongomock
 
 from mongo_proxy import MongoProxy, DurableCursor, MongoReconnectFailure
-from mongo_proxy.mongodb_proxy import Executable
+from mongo_proxy.mongodb_proxy import Executable, _Breaker, _RateLimitedLogger
+
+
+class FakeLogger:
+    """No-op logger stub; far cheaper to build than a Mock."""
+    def debug(self, *args, **kwargs):
+        pass
+
+    warning = error = info = debug
+
+
+class RecordingLogger:
+    """Logger stub that records every call for assertions."""
+    def __init__(self):
+        self.warnings = []
+        self.errors = []
+
+    def warning(self, msg, *args, **kwargs):
+        self.warnings.append((msg, args, kwargs))
+
+    def error(self, msg, *args, **kwargs):
+        self.errors.append((msg, args, kwargs))
+
+
+class FakeMethod:
+    """
+    Callable that works through a queue of results, raising entries that
+    are exceptions. Records calls like a Mock but without the per-access
+    child-mock machinery.
+    """
+    def __init__(self, results, name=None):
+        self.results = list(results)
+        self.calls = []
+        if name is not None:
+            self.__name__ = name
+
+    @property
+    def call_count(self):
+        return len(self.calls)
+
+    def __call__(self, *args, **kwargs):
+        self.calls.append((args, kwargs))
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+class FakeCursor:
+    """Iterator stub yielding queued items, raising entries that are
+    exceptions."""
+    def __init__(self, items):
+        self.items = list(items)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = self.items.pop(0)
+        if isinstance(item, Exception):
+            raise item
+        return item
 
 
 class TestMongoProxy:
@@ -35,6 +99,14 @@ class TestMongoProxy:
         mock_client, proxy = mongo_setup
         assert proxy.read_preference == mock_client.read_preference
 
+    def test_from_uri_reuses_client_per_uri_and_options(self):
+        uri = 'mongodb://localhost:27017/'
+        p1 = MongoProxy.from_uri(uri, connect=False)
+        p2 = MongoProxy.from_uri(uri, connect=False)
+        assert p1.conn is p2.conn
+        p3 = MongoProxy.from_uri(uri, connect=False, maxPoolSize=5)
+        assert p3.conn is not p1.conn
+
     def test_with_options_returns_proxied_object(self, mongo_setup):
         _, proxy = mongo_setup
         wc = WriteConcern(w=2)
@@ -51,22 +123,138 @@ class TestExecutable:
     ])
     def test_reconnect_on_various_exceptions(self, mocker, exception_type):
         mocker.patch('time.sleep')
-        method = mocker.Mock(side_effect=[exception_type("mock error"), 'Success'])
-        executable = Executable(method, mocker.Mock())
+        method = FakeMethod([exception_type("mock error"), 'Success'])
+        executable = Executable(method, FakeLogger())
+        assert executable() == 'Success'
+
+    def test_bulk_resume_reissues_uncommitted_tail(self, mocker):
+        error = pymongo.errors.BulkWriteError({
+            'writeErrors': [{'index': 2, 'code': 189}], 'nInserted': 2,
+        })
+        method = FakeMethod([error, 'Success'], name='insert_many')
+        executable = Executable(method, FakeLogger())
+        docs = [{'i': 1}, {'i': 2}, {'i': 3}, {'i': 4}]
+        assert executable(docs) == 'Success'
+        assert method.calls[1][0][0] == [{'i': 3}, {'i': 4}]
+
+    def test_bulk_resume_reraises_when_ordered_false_is_positional(self, mocker):
+        error = pymongo.errors.BulkWriteError({
+            'writeErrors': [{'index': 2, 'code': 189}], 'nInserted': 2,
+        })
+        method = FakeMethod([error], name='insert_many')
+        executable = Executable(method, FakeLogger())
+        with pytest.raises(pymongo.errors.BulkWriteError):
+            executable([{'i': 1}, {'i': 2}, {'i': 3}], False)
+
+    def test_bulk_resume_reraises_on_real_write_error(self, mocker):
+        error = pymongo.errors.BulkWriteError({
+            'writeErrors': [{'index': 2, 'code': 11000}],  # DuplicateKey
+        })
+        method = FakeMethod([error], name='insert_many')
+        executable = Executable(method, FakeLogger())
+        with pytest.raises(pymongo.errors.BulkWriteError):
+            executable([{'i': 1}, {'i': 2}, {'i': 3}])
+
+    def test_deadline_still_retries_transient_timeouts(self, mocker):
+        # NetworkTimeout carries timeout=True on pymongo 4.2+, but with
+        # deadline budget left it must still be treated as transient.
+        mocker.patch('time.sleep')
+        method = FakeMethod([pymongo.errors.NetworkTimeout("transient"), 'Success'])
+        executable = Executable(method, FakeLogger(), deadline=30)
         assert executable() == 'Success'
 
+    def test_deadline_exhaustion_stops_retrying(self):
+        calls = []
+
+        def slow_fail():
+            calls.append(1)
+            time.sleep(0.05)
+            raise pymongo.errors.NetworkTimeout("deadline hit")
+
+        executable = Executable(slow_fail, FakeLogger(), deadline=0.01)
+        with pytest.raises(pymongo.errors.NetworkTimeout):
+            executable()
+        assert len(calls) == 1
+
+    def test_autoreconnect_failure_surfaces_after_retries(self, mocker):
+        mocker.patch('time.sleep')
+        error = pymongo.errors.AutoReconnect("still down")
+        method = FakeMethod([error] * 10)
+        executable = Executable(method, FakeLogger(), max_retries=3)
+        with pytest.raises(pymongo.errors.AutoReconnect):
+            executable()
+        # Initial attempt plus the configured retries, then give up.
+        assert method.call_count == 4
+
     def test_autoreconnect_with_exponential_backoff(self, mocker):
         sleep_mock = mocker.patch('time.sleep')
-        method = mocker.Mock(side_effect=[
+        # Pin the jitter multiplier (0.5 + random()) to 1.0 so the sleeps
+        # equal the raw backoff schedule.
+        mocker.patch('random.random', return_value=0.5)
+        method = FakeMethod([
             pymongo.errors.AutoReconnect("failure 1"),
             pymongo.errors.AutoReconnect("failure 2"), "Success"
         ])
-        executable = Executable(method, mocker.Mock())
+        executable = Executable(method, FakeLogger())
         executable()
         assert sleep_mock.call_count == 2
         sleep_mock.assert_has_calls([call(0.5), call(1.0)])
 
 
+class TestRateLimitedLogger:
+    def test_duplicate_warnings_are_suppressed_within_window(self, mocker):
+        mocker.patch('time.monotonic', side_effect=[0.0, 1.0])
+        inner = RecordingLogger()
+        logger = _RateLimitedLogger(inner, window=5.0)
+        logger.warning('retrying %s', 'find')
+        logger.warning('retrying %s', 'count')
+        assert len(inner.warnings) == 1
+        assert inner.warnings[0] == ('retrying %s', ('find',), {})
+
+    def test_suppressed_repeats_are_summarized_after_window(self, mocker):
+        mocker.patch('time.monotonic', side_effect=[0.0, 1.0, 10.0])
+        inner = RecordingLogger()
+        logger = _RateLimitedLogger(inner, window=5.0)
+        logger.warning('retrying %s', 'find')
+        logger.warning('retrying %s', 'find')
+        logger.warning('retrying %s', 'find')
+        assert [w[0] for w in inner.warnings] == [
+            'retrying %s',
+            '(%d similar warnings suppressed in the last %.0f seconds)',
+            'retrying %s',
+        ]
+        assert inner.warnings[1][1] == (1, 10.0)
+
+    def test_warning_forwards_keyword_arguments(self):
+        inner = RecordingLogger()
+        logger = _RateLimitedLogger(inner)
+        logger.warning('boom', exc_info=True)
+        assert inner.warnings == [('boom', (), {'exc_info': True})]
+
+    def test_other_methods_pass_through(self):
+        inner = RecordingLogger()
+        logger = _RateLimitedLogger(inner)
+        logger.error('bad %s', 'thing', exc_info=True)
+        logger.error('bad %s', 'thing', exc_info=True)
+        # No rate limiting on error; both calls reach the real logger.
+        assert inner.errors == [('bad %s', ('thing',), {'exc_info': True})] * 2
+
+
+class TestBreaker:
+    def test_opens_after_threshold_and_recloses_on_success(self):
+        breaker = _Breaker(threshold=3, cooldown=60)
+        error = pymongo.errors.AutoReconnect("down")
+        for _ in range(2):
+            breaker.record_failure(error)
+        assert not breaker.is_open()
+        breaker.record_failure(error)
+        assert breaker.is_open()
+        assert breaker.last_exc is error
+        breaker.record_success()
+        assert not breaker.is_open()
+        assert breaker.failures == 0
+
+
 class TestDurableCursor:
     @pytest.fixture
     def populated_collection(self):
@@ -81,6 +269,94 @@ class TestDurableCursor:
         cursor = DurableCursor(collection)
         assert list(cursor) == []
 
+    def test_prefetch_iteration_yields_all_documents(self, populated_collection):
+        collection, _ = populated_collection
+        cursor = DurableCursor(collection, batch_size=3, prefetch=True)
+        results = list(cursor)
+        assert [doc['i'] for doc in results] == list(range(1, 11))
+
+    def test_prefetch_worker_exits_when_iteration_abandoned(self, populated_collection):
+        collection, _ = populated_collection
+        cursor = DurableCursor(collection, batch_size=2, prefetch=True)
+        iterator = iter(cursor)
+        next(iterator)
+        iterator.close()
+
+        def worker_alive():
+            return any(t.name == 'durable-cursor-prefetch' and t.is_alive()
+                       for t in threading.enumerate())
+
+        deadline = time.monotonic() + 2
+        while worker_alive() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert not worker_alive()
+
+    def test_eager_cursor_materializes_and_reiterates(self, populated_collection, mocker):
+        collection, _ = populated_collection
+        cursor = DurableCursor(collection, eager=True)
+        count_mock = mocker.patch.object(collection, 'count_documents')
+        assert [doc['i'] for doc in cursor] == list(range(1, 11))
+        # The buffer can be iterated again and count() skips the server.
+        assert [doc['i'] for doc in cursor] == list(range(1, 11))
+        assert cursor.count() == 10
+        count_mock.assert_not_called()
+
+    def test_eager_cursor_serves_direct_next_from_buffer(self, populated_collection):
+        collection, _ = populated_collection
+        cursor = DurableCursor(collection, eager=True)
+        assert cursor.next()['i'] == 1
+        assert next(cursor)['i'] == 2
+        assert [doc['i'] for doc in cursor.to_list()] == list(range(1, 11))
+        for _ in range(8):
+            next(cursor)
+        with pytest.raises(StopIteration):
+            next(cursor)
+
+    def test_to_list_materializes_documents(self, populated_collection):
+        collection, _ = populated_collection
+        assert [doc['i'] for doc in DurableCursor(collection).to_list()] == \
+            list(range(1, 11))
+        assert [doc['i'] for doc in DurableCursor(collection).to_list(length=3)] == \
+            [1, 2, 3]
+
+    def test_count_is_cached_until_invalidated(self, populated_collection, mocker):
+        collection, _ = populated_collection
+        cursor = DurableCursor(collection, skip=2, limit=5)
+        count_mock = mocker.patch.object(
+            collection, 'count_documents', wraps=collection.count_documents)
+        assert cursor.count() == 10
+        assert cursor.count() == 10
+        assert count_mock.call_count == 1
+        assert cursor.count(with_limit_and_skip=True) == 5
+        assert count_mock.call_count == 2
+        cursor.invalidate_count()
+        assert cursor.count() == 10
+        assert count_mock.call_count == 3
+
+    def test_alive_is_false_once_limit_is_exhausted(self, populated_collection):
+        collection, _ = populated_collection
+        cursor = DurableCursor(collection, tailable=True, limit=2)
+        assert next(cursor)['i'] == 1
+        assert next(cursor)['i'] == 2
+        # Reloading past the limit swaps in an empty iterator; alive must
+        # report False rather than blow up on it.
+        cursor.reload_cursor()
+        assert cursor.alive is False
+
+    def test_length_hint_reflects_cached_count(self, populated_collection):
+        collection, _ = populated_collection
+        cursor = DurableCursor(collection)
+        assert cursor.__length_hint__() == 0
+        cursor.count()
+        assert cursor.__length_hint__() == 10
+
+    def test_batch_iter_yields_all_documents(self, populated_collection):
+        collection, test_data = populated_collection
+        cursor = DurableCursor(collection)
+        results = list(cursor.batch_iter(batch_size=3))
+        assert [doc['i'] for doc in results] == list(range(1, 11))
+        assert cursor.counter == 10
+
     @pytest.mark.parametrize("error_type", [
         pymongo.errors.AutoReconnect,
         pymongo.errors.CursorNotFound,
@@ -90,20 +366,18 @@ class TestDurableCursor:
         collection, test_data = populated_collection
         original_find = collection.find
 
-        # Create a pure mock iterator for the first, failing cursor.
-        failing_cursor_mock = MagicMock()
-        failing_cursor_mock.__iter__.return_value = failing_cursor_mock
-        failing_cursor_mock.__next__.side_effect = [
+        # A stub iterator for the first, failing cursor.
+        failing_cursor = FakeCursor([
             test_data[0],
             test_data[1],
             error_type("mock failure")
-        ]
+        ])
 
         # Use a router function for the mock's side_effect.
         def find_router(*args, **kwargs):
-            # The initial call has skip=0. Return the failing mock.
+            # The initial call has skip=0. Return the failing stub.
             if kwargs.get('skip', 0) == 0:
-                return failing_cursor_mock
+                return failing_cursor
             # The reconnect call has skip=2. Let the original method handle it
             # so we get a real cursor that respects the skip argument.
             return original_find(*args, **kwargs)
@@ -117,6 +391,38 @@ class TestDurableCursor:
         assert [doc['i'] for doc in results] == list(range(1, 11))
         assert find_mock.call_count == 2
 
+    def test_resume_by_id_reconnects_with_id_filter(self, populated_collection, mocker):
+        mocker.patch('time.sleep')
+        collection, _ = populated_collection
+        original_find = collection.find
+        all_docs = list(original_find(sort=[('_id', 1)]))
+
+        failing_cursor = FakeCursor([
+            all_docs[0],
+            all_docs[1],
+            pymongo.errors.AutoReconnect("mock failure")
+        ])
+
+        def find_router(*args, **kwargs):
+            if '_id' not in kwargs.get('filter', {}):
+                return failing_cursor
+            return original_find(*args, **kwargs)
+
+        find_mock = mocker.patch.object(collection, 'find', side_effect=find_router)
+
+        d_cursor = DurableCursor(collection, resume_by_id=True)
+        results = list(d_cursor)
+
+        assert [doc['i'] for doc in results] == list(range(1, 11))
+        resume_kwargs = find_mock.call_args_list[-1].kwargs
+        assert resume_kwargs['filter'] == {'_id': {'$gt': all_docs[1]['_id']}}
+        assert resume_kwargs['skip'] == 0
+
+    def test_resume_by_id_rejects_custom_sort(self):
+        collection = mongomock.MongoClient().db.collection
+        with pytest.raises(ValueError):
+            DurableCursor(collection, sort=[('i', 1)], resume_by_id=True)
+
     def test_reconnect_with_initial_skip_and_limit(self, populated_collection, mocker):
         mocker.patch('time.sleep')
         collection, test_data = populated_collection
@@ -125,18 +431,16 @@ class TestDurableCursor:
         initial_skip = 2
         initial_limit = 5
 
-        failing_cursor_mock = MagicMock()
-        failing_cursor_mock.__iter__.return_value = failing_cursor_mock
-        failing_cursor_mock.__next__.side_effect = [
+        failing_cursor = FakeCursor([
             test_data[2],  # i=3
             test_data[3],  # i=4
             pymongo.errors.AutoReconnect("fail")
-        ]
+        ])
 
         # Use the same robust router strategy.
         def find_router(*args, **kwargs):
             if kwargs.get('skip') == initial_skip:
-                return failing_cursor_mock
+                return failing_cursor
             return original_find(*args, **kwargs)
 
         find_mock = mocker.patch.object(collection, 'find', side_effect=find_router)